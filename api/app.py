@@ -21,6 +21,8 @@ class RagnalysisClient:
                do_sample: Optional[bool] = True, frequency_penalty: Optional[float] = 0,
                presence_penalty: Optional[float] = 0, max_new_tokens: Optional[int] = 200,
                chunk_limit: Optional[int] = 150, k: Optional[int] = 3, 
+               include_chunks: Optional[bool] = False, include_prompt: Optional[bool] = False,
+               no_cache: Optional[bool] = False,
                debug: Optional[bool] = False, locale: Optional[str] = 'en') -> dict[str: any]:
         
         try:
@@ -37,6 +39,9 @@ class RagnalysisClient:
                     "max_new_tokens": max_new_tokens,
                     "chunk_limit": chunk_limit,
                     "k": k,
+                    "include_chunks": include_chunks or self.persist,  # _persist() stores the chunk text
+                    "include_prompt": include_prompt,
+                    "no_cache": no_cache,
                     "locale": locale
                 }
             )
@@ -59,7 +64,8 @@ class RagnalysisClient:
 
         spark = SparkSession.builder.getOrCreate()
         spark_df = spark.createDataFrame(df)
-        spark_df.write.mode("append").format("delta").saveAsTable("responses")
+        # Responses gain fields over time (ex. include_chunks, cached), so new columns are merged into the table
+        spark_df.write.mode("append").format("delta").option("mergeSchema", "true").saveAsTable("responses")
 
     def llama(self, prompt: str, **kwargs):
         return self._model(prompt, model='llama', **kwargs)
@@ -1,22 +1,289 @@
 # pylint: skip-file
 import os
-import json
+import base64
 import time
+import hashlib
+import asyncio
 import logging
-import requests
+from functools import lru_cache
+from dataclasses import dataclass, asdict, fields
+import aiohttp
+import orjson
+import faiss
 import numpy as np
+from cachetools import LRUCache, TTLCache
 import azure.functions as func
-from utils import timer, count_tokens
+from utils import timer, count_tokens, BatchItemError, Coalescer, Hedger
 
 
-# Pay-as-you-go cost table per 1000 tokens. Format is [input cost, output cost]
+# Pay-as-you-go cost table per 1000 tokens. Format is (input cost, output cost)
 LLM_RATES = {
-    'gpt35_4k': [0.0021, 0.003], 
-    'gpt35_16k': [0.0007, 0.0021], 
-    'gpt4_1106': [0.041, 0.082]
+    'gpt35_4k': (0.0021, 0.003), 
+    'gpt35_16k': (0.0007, 0.0021), 
+    'gpt4_1106': (0.041, 0.082)
+}
+
+# tiktoken model whose tokenizer matches each pay-as-you-go model (both resolve to cl100k_base)
+LLM_TOKENIZERS = {
+    'gpt35_4k': 'gpt-3.5-turbo',
+    'gpt35_16k': 'gpt-3.5-turbo',
+    'gpt4_1106': 'gpt-4'
 }
 
 EMBED_COST = 0.000136  # per 1000 tokens
+EMBED_DIM = 1536  # size of an ada002 embedding
+
+# Endpoints and headers are fixed per model, so they are resolved once instead of on every request
+_EMBED_URL = "https://ragnalysis.openai.azure.com/openai/deployments/ada_embedding/embeddings?api-version=2023-05-15"
+_AI_STUDIO_URLS = {
+    model: f"https://ragnalysis.openai.azure.com/openai/deployments/{model}/chat/completions?api-version=2023-05-15"
+    for model in LLM_RATES
+}
+_CONTAINER_URL = "https://localai-selfhost.salmonground-3deb4a95.canadaeast.azurecontainerapps.io/chat/completions"
+
+
+@lru_cache(maxsize=None)
+def _openai_headers() -> dict:
+    """Headers for the Azure OpenAI endpoints. Raises KeyError (uncached) if OPENAI_KEY is not set"""
+    return { "Content-Type": "application/json", "api-key": os.environ['OPENAI_KEY'] }
+
+
+@lru_cache(maxsize=None)
+def _ml_studio_config(model: str) -> tuple[str, dict]:
+    """URL and headers for an ML Studio model endpoint. Raises KeyError (uncached) if its key is not set"""
+    return (
+        f'https://ragnalysis-{model}.eastus2.inference.ml.azure.com/score',
+        {
+            'Content-Type':'application/json',
+            'Authorization':('Bearer '+ os.environ[f'{model.upper()}_KEY'])
+        }
+    )
+
+# Embeddings are deterministic for a given input, so repeated prompts skip the embedding API call
+_EMBED_CACHE = LRUCache(maxsize=4096)
+
+
+@lru_cache(maxsize=4096)
+def _embed_tokens(body: str) -> int:
+    """Embedding token count for a user prompt, cached alongside its embedding. Full LLM prompts and
+    responses are rarely repeated, so they go through count_tokens uncached"""
+    return count_tokens(body, 'text-embedding-ada-002')
+
+# Recent responses, so repeated queries skip the embed -> search -> generate chain entirely.
+# A cache hit spends nothing, so it reports zero runtime, tokens and cost
+_RESPONSE_CACHE = TTLCache(maxsize=1024, ttl=120)
+_CACHE_HIT_LOGS = {
+    "runtime": {"embed": 0, "search": 0, "generate": 0, "total": 0},
+    "tokens": {"embed": {"in": 0, "out": 0}, "llm": {"in": 0, "out": 0}},
+    "cost": {"embed": 0, "llm": 0, "total": 0}
+}
+
+# Shared HTTP session so keep-alive connections to the model endpoints are reused across requests
+_SESSION = None
+_SESSION_LOOP = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Returns the shared HTTP session, creating it on first use (or if the event loop changed)"""
+    global _SESSION, _SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _SESSION is None or _SESSION.closed or _SESSION_LOOP is not loop:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, keepalive_timeout=60),
+            json_serialize=lambda obj: orjson.dumps(obj).decode()
+        )
+        _SESSION_LOOP = loop
+    return _SESSION
+
+
+async def _embed_batch(bodies: list[str]) -> list[np.ndarray]:
+    """Embeds several prompts in a single call to the ADA embedding API
+    
+    Returns:
+        list[np.ndarray]    : one (1, 1536) float32 embedding per prompt, in the same order as `bodies`
+
+    """
+    headers = _openai_headers()
+    try:
+        async with _get_session().post(
+            url = _EMBED_URL, 
+            headers = headers, 
+            json = { "input": bodies, "encoding_format": "base64" }
+        ) as resp:
+            # A 400 means one of the prompts was rejected (ex. too long), so the coalescer retries them separately.
+            # Throttling (429) and server errors would fail every retry too, so they fail the batch as a whole
+            if resp.status == 400:
+                raise BatchItemError('Embedding error: ADA embedding API rejected the prompt (ex. it is too long)')
+            if resp.status != 200:
+                raise Exception(f'Embedding error: ADA embedding API returned HTTP {resp.status}')
+            data = sorted((await resp.json(content_type=None, loads=orjson.loads))['data'], key=lambda item: item['index'])
+    except KeyError as e:
+        # The batch holds other users' prompts, so none of them go in the error message
+        raise Exception(f'{e}: Embedding error: ADA embedding API failed to embed the prompt')
+
+    # Base64 embeddings are raw little-endian float32 bytes, so each row is a straight copy instead of
+    # converting 1536 JSON floats. Falls back to the float list if the endpoint ignores encoding_format.
+    # Each row gets its own array so a cached embedding doesn't keep the whole batch alive
+    embeddings = []
+    for item in data:
+        embedding = item['embedding']
+        if isinstance(embedding, str):
+            embedding = np.frombuffer(base64.b64decode(embedding), dtype='<f4')
+        embeddings.append(np.array(embedding, dtype='float32').reshape(1, EMBED_DIM))
+    return embeddings
+
+
+# Concurrent requests share embedding API calls (Azure caps each call at 16 inputs)
+_EMBED_COALESCER = Coalescer(_embed_batch, batch_size=16, max_delay=0.015)
+
+
+def _search_single_threaded(index, embedding: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Searches with one OpenMP thread. Single-vector queries gain nothing from OpenMP, and extra threads
+    starve concurrent requests. The setting is per thread, so it is applied on the worker thread doing the search"""
+    faiss.omp_set_num_threads(1)
+    return index.search(embedding, k)
+
+
+# LLM calls still running after HEDGE_DELAY seconds are raced against a duplicate (capped at 5% of calls)
+_HEDGER = Hedger(delay=float(os.environ.get('HEDGE_DELAY') or 0.8), budget=0.05)
+
+
+class BatchedIndex():
+    """Wraps a GPU FAISS index so that concurrent single-vector searches run as one batched search.
+    A single query is slower on GPU than on CPU, so lone queries (nothing else in flight, or a batch of one)
+    are searched on the CPU copy of the index instead
+
+    Args:
+        index       : the GPU index, used for batches of two or more queries
+        cpu_index   : the CPU index the GPU index was cloned from
+        batch_size  : max number of queries per batched search
+        max_delay   : how long (in seconds) to wait for more queries before searching a partial batch
+
+    """
+
+    def __init__(self, index, cpu_index, batch_size: int = 64, max_delay: float = 0.01) -> None:
+        self.index = index
+        self.cpu_index = cpu_index
+        self.threads = min(os.cpu_count() or 1, 4)
+        self._coalescer = Coalescer(self._search_batch, batch_size=batch_size, max_delay=max_delay)
+        self._in_flight = 0
+
+    async def search(self, embedding: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        self._in_flight += 1
+        try:
+            if self._in_flight == 1:
+                # Nothing to batch with, so skip the coalescing delay
+                return await asyncio.to_thread(_search_single_threaded, self.cpu_index, embedding, k)
+            return await self._coalescer.submit((embedding, k))
+        finally:
+            self._in_flight -= 1
+
+    async def _search_batch(self, queries: list[tuple[np.ndarray, int]]) -> list[tuple[np.ndarray, np.ndarray]]:
+        if len(queries) == 1:
+            return [await asyncio.to_thread(_search_single_threaded, self.cpu_index, *queries[0])]
+        embeddings, ks = zip(*queries)
+        scores, ids = await asyncio.to_thread(self._search, np.vstack(embeddings), max(ks))
+        return [(scores[i:i+1, :k], ids[i:i+1, :k]) for i, k in enumerate(ks)]
+
+    def _search(self, embeddings: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # Batches are large enough to benefit from OpenMP, unlike the single-threaded per-query default
+        threads = faiss.omp_get_max_threads()
+        faiss.omp_set_num_threads(self.threads)
+        try:
+            return self.index.search(embeddings, k)
+        finally:
+            faiss.omp_set_num_threads(threads)
+
+
+def _flag(value) -> bool:
+    return value in ["True", True]
+
+
+@dataclass
+class RagParams():
+    """Model parameters for a request, read from the query string (or the JSON body as a fallback)
+    
+    Args: 
+        body                : the prompt
+        use_rag             : whether to pass extra context or to just use the prompt
+        temperature         : randomness (higher = more)
+        top_p               : top % of most similar tokens to sample from
+        do_sample           : sample from a distribution of words, or just use the most likely word
+        frequency_penalty   : incremental penalty based on frequency of token use
+        presence_penalty    : flat penalty each time a repeated token is used
+        max_new_tokens      : max tokens to produce in the response
+        chunk_limit         : limit the size of each chunk passed to the llm (mostly for large chunk sizes)  
+        k                   : how many chunks to pass to the llm as context
+        include_chunks      : whether to return the full chunk text with each source (off by default to keep responses small)
+        include_prompt      : whether to echo the full prompt sent to the llm in the response parameters
+        no_cache            : whether to skip the response cache and always generate a fresh response
+
+    """
+    body: str = None
+    use_rag: bool = True
+    temperature: float = 0.9
+    top_p: float = 0.9
+    do_sample: bool = True
+    frequency_penalty: float = 0
+    presence_penalty: float = 0
+    max_new_tokens: int = 200
+    chunk_limit: int = 150
+    k: int = 3
+    include_chunks: bool = False
+    include_prompt: bool = False
+    no_cache: bool = False
+
+    @classmethod
+    def from_request(cls, req: func.HttpRequest) -> 'RagParams':
+        """Parses the request in a single pass. Missing or empty parameters fall back to the defaults"""
+        raw = dict(req.params)
+
+        if not raw.get('body'):
+            try:
+                payload = orjson.loads(req.get_body())
+            except ValueError:
+                pass
+            else:
+                if isinstance(payload, dict):
+                    raw = {**payload, **raw, 'body': payload.get('body')}
+
+        return cls(*_PARSE(raw))
+
+
+# Casts applied to each raw (string) request parameter
+_COERCE = {
+    'body': str,
+    'use_rag': _flag,
+    'temperature': float,
+    'top_p': float,
+    'do_sample': _flag,
+    'frequency_penalty': float,
+    'presence_penalty': float,
+    'max_new_tokens': int,
+    'chunk_limit': int,
+    'k': int,
+    'include_chunks': _flag,
+    'include_prompt': _flag,
+    'no_cache': _flag
+}
+
+
+def _compile_parser(params_cls, coerce: dict):
+    """Generates one function that reads and casts every field of `params_cls` from a raw dict, in field order.
+    The schema is fixed, so this avoids looping over the casts and building a kwargs dict on every request"""
+    namespace = {}
+    lines = []
+    for i, field in enumerate(fields(params_cls)):
+        namespace[f'_default{i}'] = field.default
+        namespace[f'_cast{i}'] = coerce[field.name]
+        lines.append(f"        _default{i} if (value := get({field.name!r})) is None or value == '' else _cast{i}(value),")
+
+    source = "def parse(raw):\n    get = raw.get\n    return (\n" + "\n".join(lines) + "\n    )"
+    exec(compile(source, '<params>', 'exec'), namespace)
+    return namespace['parse']
+
+
+_PARSE = _compile_parser(RagParams, _COERCE)
 
 
 class rag():
@@ -26,154 +293,187 @@ class rag():
         """Extracting model parameters from the request object
         
         Args: 
-            body                : the prompt
-            model               : which model to use (ex gpt, llama, mistral)
-            use_rag             : whether to pass extra context or to just use the prompt
-            temperature         : randomness (higher = more)
-            top_p               : top % of most similar tokens to sample from
-            do_sample           : sample from a distribution of words, or just use the most likely word
-            frequency_penalty   : incremental penalty based on frequency of token use
-            presence_penalty    : flat penalty each time a repeated token is used
-            max_new_tokens      : max tokens to produce in the response
-            chunk_limit         : limit the size of each chunk passed to the llm (mostly for large chunk sizes)  
-            k                   : how many chunks to pass to the llm as context
+            req     : the HTTP request; its parameters are parsed into a RagParams
+            model   : which model to use (ex gpt, llama, mistral)
 
         """
-        self.body = req.params.get('body')
-
-        if not self.body:
-            try:
-                req = req.get_json()
-            except ValueError:
-                pass
-            else:
-                self.body = req.get('body')
-
         self.model = model
-        self.use_rag = req.params.get('use_rag') in ["True", True, None]
-        self.temperature = float(req.params.get('temperature') or 0.9)
-        self.top_p = float(req.params.get('top_p') or 0.9)
-        self.do_sample = req.params.get('do_sample') in ["True", True, None]
-        self.frequency_penalty = float(req.params.get('frequency_penalty') or 0)
-        self.presence_penalty = float(req.params.get('presence_penalty') or 0) 
-        self.max_new_tokens = int(req.params.get('max_new_tokens') or 200)
-        self.chunk_limit = int(req.params.get('chunk_limit') or 150)
-        self.k = int(req.params.get('k') or 3) 
-
-    def generate(self, data, index) -> func.HttpResponse:
-        """Main method; coordinates other methods
+        self.params = RagParams.from_request(req)
+
+    async def generate(self, data, index) -> func.HttpResponse:
+        """Main method; coordinates other methods. Independent steps (ex. embedding the prompt and
+        counting its tokens) are run concurrently so their latencies overlap instead of adding up
         
         Args:
-            data    : pd.DataFrame containing all the chunks
+            data    : column-wise view of the chunks ({'title', 'url', 'chunks'} -> np.ndarray), indexed by FAISS id
             index   : FAISS index containing embeddings for the chunks
 
         """
-        if self.body:
+        if self.params.body:
+            cache_key = self._cache_key()
+            cached = _RESPONSE_CACHE.get(cache_key) if cache_key else None
+            if cached is not None:
+                return func.HttpResponse(
+                    orjson.dumps({
+                        "id": round(time.time() * 1e3),
+                        **cached,
+                        "cached": True,
+                        "logs": _CACHE_HIT_LOGS
+                    }, option=orjson.OPT_SERIALIZE_NUMPY),
+                    mimetype="application/json"
+                )
+
+            llm_tokens_in = None
             try:
-                embedding, embed_time = self._embed()
-                (scores, ids), search_time = self._index(index, embedding)
-                relevant_data = data.iloc[ids[0]]  # the most relevant chunks
-                context = list(relevant_data['chunks'].str[:self.chunk_limit])  # joining the relevant chunks into a single string
+                session = _get_session()
+                (embedding, embed_time), embed_tokens = await asyncio.gather(
+                    self._embed(),
+                    asyncio.to_thread(_embed_tokens, self.params.body)
+                )
+                (scores, ids), search_time = await self._index(index, embedding)
+                scores, ids = scores[0], ids[0]  # the most relevant chunks
+                # Context is only needed when RAG is on; fancy-indexing the chunk array avoids a per-id lookup
+                context = [chunk[:self.params.chunk_limit] for chunk in data['chunks'][ids]] if self.params.use_rag else []
                 prompt = self._prompt(context)
-                response, generate_time = self._augment(prompt)
+                tokenizer = LLM_TOKENIZERS.get(self.model, 'gpt-3.5-turbo')  # approximate for non-GPT models
+                # Tokenizing the prompt is CPU-bound, so it runs on a worker thread while the LLM call is in flight
+                llm_tokens_in = asyncio.ensure_future(
+                    asyncio.to_thread(count_tokens, ' '.join(item['content'] for item in prompt), tokenizer)
+                )
+                response, generate_time = await self._augment(session, prompt)
             except Exception as e:
+                # The prompt token count is no longer needed; if it already finished, retrieve its result so errors aren't left unhandled
+                if llm_tokens_in is not None and not llm_tokens_in.cancel():
+                    llm_tokens_in.exception()
                 return func.HttpResponse(
-                    json.dumps({"error": f"{e}: API failed to process"}), 
+                    orjson.dumps({"error": f"{e}: API failed to process"}), 
                     status_code=400
                 )
 
             logging.info("Response: %s", response)
 
             # Telemetry calculation:
-            embed_tokens = count_tokens(self.body, 'text-embedding-ada-002')
             embed_cost = embed_tokens / 1000 * EMBED_COST
-            llm_tokens_in = count_tokens(' '.join([list(item.values())[1] for item in prompt]), 'gpt-3.5-turbo')
-            llm_tokens_out = count_tokens(response, 'gpt-3.5-turbo')
-            llm_cost = 0 if not LLM_RATES.get(self.model) else np.dot(LLM_RATES.get(self.model), [llm_tokens_in/1000, llm_tokens_out/1000])
+            rates = LLM_RATES.get(self.model)
+            if rates is None:
+                # No cost to calculate, and the GPT tokenizer would miscount other models' output anyway
+                llm_tokens_in, llm_tokens_out, llm_cost = await llm_tokens_in, None, 0
+            else:
+                llm_tokens_in, llm_tokens_out = await asyncio.gather(
+                    llm_tokens_in,
+                    asyncio.to_thread(count_tokens, response, tokenizer)
+                )
+                llm_cost = (rates[0] * llm_tokens_in + rates[1] * llm_tokens_out) / 1000
 
             try:
-                return func.HttpResponse(
-                    json.dumps({
-                        "id": round(time.time() * 1e3),
-                        "response": response,
-                        "sources": relevant_data.assign(similarity=scores[0])[['title', 'similarity', 'url', 'chunks']].to_dict(orient='records'),
-                        "parameters": self.__dict__,
-                        "logs": {
-                            "runtime": {
-                                "embed": round(embed_time, 2),
-                                "search": round(search_time, 2),
-                                "generate": round(generate_time, 2),
-                                "total": round(embed_time + search_time + generate_time, 2)
-                            },
-                            "tokens": {
-                                "embed": {
-                                    "in": embed_tokens,
-                                    "out": len(embedding[0])
-                                },
-                                "llm": {
-                                    "in": llm_tokens_in,
-                                    "out": llm_tokens_out
-                                },
+                # Cached without the id and telemetry, since replaying those would double-count spend
+                payload = {
+                    "response": response,
+                    "sources": [
+                        {
+                            "title": data['title'][i],
+                            "similarity": score,
+                            "url": data['url'][i],
+                            **({"chunks": data['chunks'][i]} if self.params.include_chunks else {})
+                        }
+                        for i, score in zip(ids, scores)
+                    ],
+                    "parameters": {
+                        "model": self.model,
+                        **asdict(self.params),
+                        **({"prompt": prompt} if self.params.include_prompt else {})
+                    }
+                }
+                body = orjson.dumps({
+                    "id": round(time.time() * 1e3),
+                    **payload,
+                    "cached": False,
+                    "logs": {
+                        "runtime": {
+                            "embed": round(embed_time, 2),
+                            "search": round(search_time, 2),
+                            "generate": round(generate_time, 2),
+                            "total": round(embed_time + search_time + generate_time, 2)
+                        },
+                        "tokens": {
+                            "embed": {
+                                "in": embed_tokens,
+                                "out": len(embedding[0])
                             },
-                            "cost": {
-                                "embed": embed_cost,
-                                "llm": llm_cost,
-                                "total": embed_cost + llm_cost
+                            "llm": {
+                                "in": llm_tokens_in,
+                                "out": llm_tokens_out
                             },
-                        }
-                    }),
+                        },
+                        "cost": {
+                            "embed": embed_cost,
+                            "llm": llm_cost,
+                            "total": embed_cost + llm_cost
+                        },
+                    }
+                }, option=orjson.OPT_SERIALIZE_NUMPY)
+                if cache_key:
+                    _RESPONSE_CACHE[cache_key] = payload
+                return func.HttpResponse(
+                    body,
                     mimetype="application/json"
                 )
             except Exception as e:
                 return func.HttpResponse(
-                    json.dumps({"error": f"{e}: API successfully generated response, but failed to send: {response}"}), 
+                    orjson.dumps({"error": f"{e}: API successfully generated response, but failed to send: {response}"}), 
                     status_code=400
                 )
         else:
             return func.HttpResponse(
-                json.dumps({"success": "This HTTP triggered function executed successfully. Pass a body in the query string or in the request body for a personalized response."}),
+                orjson.dumps({"success": "This HTTP triggered function executed successfully. Pass a body in the query string or in the request body for a personalized response."}),
                 status_code=200
             )
 
+    def _cache_key(self) -> bytes:
+        """Key for the response cache, or None if this request should not be cached. High temperatures
+        are excluded since repeating the query is expected to give a different response"""
+        if self.params.no_cache or self.params.temperature > 0.3:
+            return None
+        return hashlib.blake2b(orjson.dumps([self.model, asdict(self.params)]), digest_size=16).digest()
+
     @timer
-    def _embed(self) -> tuple[list[float], float]:
-        """Embedding the user prompt into a numeric vector representation for processing
+    async def _embed(self) -> tuple[list[float], float]:
+        """Embedding the user prompt into a numeric vector representation for processing. The API call
+        is batched with any other prompts submitted at the same time
         
         Returns:
             list[float] : an ada002 embedding of size 1536
             float       : function runtime in seconds 
         
         """
-        try:
-            embedding = requests.post(
-                url = "https://ragnalysis.openai.azure.com/openai/deployments/ada_embedding/embeddings?api-version=2023-05-15", 
-                headers = { "Content-Type": "application/json", "api-key": os.environ['OPENAI_KEY'] }, 
-                json = { "input": self.body }
-            ).json()['data'][0]['embedding']
-        except KeyError as e:
-            raise Exception(f'{e}: Embedding error: ADA embedding API failed to embed: %s', self.body) 
-        else:
-            return np.array([embedding], dtype='float32')
+        embedding = _EMBED_CACHE.get(self.params.body)
+        if embedding is None:
+            embedding = _EMBED_CACHE[self.params.body] = await _EMBED_COALESCER.submit(self.params.body)
+        return embedding
 
     @timer
-    def _index(self, index, embedding) -> tuple[list[float], list[int], float]:
-        """Searches the FAISS index using the prompt embedding for the most similar chunk embeddings 
+    async def _index(self, index, embedding) -> tuple[list[float], list[int], float]:
+        """Searches the FAISS index using the prompt embedding for the most similar chunk embeddings.
+        The search is CPU-bound, so it runs on a worker thread to keep the event loop free
         
         Returns:
             list[float]     : similarity scores of the retrieved chunks in the range [0, 1]
-            list[int]       : indexes of the most relevant chunks in the pd.DataFrame containing the chunks in string form
+            list[int]       : FAISS ids of the most relevant chunks, used to index the column-wise chunk arrays in `data`
             float           : function runtime in seconds
 
         """
-        scores, ids = index.search(embedding, k=self.k)
+        if isinstance(index, BatchedIndex):
+            scores, ids = await index.search(embedding, self.params.k)
+        else:
+            scores, ids = await asyncio.to_thread(_search_single_threaded, index, embedding, self.params.k)
         return scores, ids
 
     def _prompt(self, context: list[str]) -> list[dict]:
         try:
-            if not self.use_rag:
+            if not self.params.use_rag:
                 return [{
                     "role": "user",
-                    "content": self.body
+                    "content": self.params.body
                 }]
 
             prompt = [
@@ -193,7 +493,7 @@ class rag():
                 })
             prompt.append({
                 "role": "user",
-                "content": self.body
+                "content": self.params.body
             })
 
             return prompt
@@ -202,42 +502,40 @@ class rag():
             raise Exception(f"{e}: Prompt creation failed. Context: {context}")
 
     @timer
-    def _augment(self, prompt: list[dict]) -> tuple[str, float]:
+    async def _augment(self, session: aiohttp.ClientSession, prompt: list[dict]) -> tuple[str, float]:
         """Parent function for choosing which LLM to prompt for a response"""
 
-        if self.model in ['llama', 'mistral']:
-            response = self._ml_studio_model(prompt)
-        elif self.model in ['gpt35_4k', 'gpt35_16k', 'gpt4_1106']:
-            response = self._ai_studio_model(prompt)
-        elif self.model in ['qwen']:
-            response = self._containerized_model(prompt)
-        else:
+        child = self._AUGMENT_DISPATCH.get(self.model)
+        if child is None:
             raise Exception("Augment error: Invalid model choice")
-        return response
+        return await child(self, session, prompt)
 
-    def _ml_studio_model(self, prompt: list[dict]) -> str:
+    async def _ml_studio_model(self, session: aiohttp.ClientSession, prompt: list[dict]) -> str:
         """Child function (1/3) of _augment() that routes to the ML Studio models"""
         # NOTE: Please reformat the "input_data" key if you are not using a 'Chat Completions' model
         response = None
-        try:
-            response = requests.post(
-                url = f'https://ragnalysis-{self.model}.eastus2.inference.ml.azure.com/score',
-                headers = {
-                    'Content-Type':'application/json',
-                    'Authorization':('Bearer '+ os.environ[f'{self.model.upper()}_KEY'])
-                },
+
+        async def call():
+            url, headers = _ml_studio_config(self.model)
+            async with session.post(
+                url = url,
+                headers = headers,
                 json = {
                     "input_data": {
                         "input_string": prompt,
                         "parameters": {
-                            "temperature": self.temperature,
-                            "top_p": self.top_p,
-                            "do_sample": self.do_sample,
-                            "max_new_tokens": self.max_new_tokens
+                            "temperature": self.params.temperature,
+                            "top_p": self.params.top_p,
+                            "do_sample": self.params.do_sample,
+                            "max_new_tokens": self.params.max_new_tokens
                         }
                     }
                 }
-            ).json()
+            ) as resp:
+                return await resp.json(content_type=None, loads=orjson.loads)
+
+        try:
+            response = await _HEDGER.run(call)
             return response.get('output')
         except Exception as e:
             if not response:
@@ -247,23 +545,28 @@ class rag():
                         Try setting use_rag to False to see if it is an issue with the context. \n \
                         Response object: {response}')
 
-    def _ai_studio_model(self, prompt: list[dict]) -> str:
+    async def _ai_studio_model(self, session: aiohttp.ClientSession, prompt: list[dict]) -> str:
         """Child function (2/3) of _augment() that routes to the OpenAI Studio models"""
         response = None
-        try:
-            response = requests.post(
-                url = f"https://ragnalysis.openai.azure.com/openai/deployments/{self.model}/chat/completions?api-version=2023-05-15", 
-                headers = { "Content-Type": "application/json", "api-key": os.environ['OPENAI_KEY'] }, 
+
+        async def call():
+            async with session.post(
+                url = _AI_STUDIO_URLS[self.model], 
+                headers = _openai_headers(), 
                 json = { 
                     "messages": prompt,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "frequency_penalty": self.frequency_penalty,
-                    "presence_penalty": self.presence_penalty,
-                    "max_tokens": self.max_new_tokens,
+                    "temperature": self.params.temperature,
+                    "top_p": self.params.top_p,
+                    "frequency_penalty": self.params.frequency_penalty,
+                    "presence_penalty": self.params.presence_penalty,
+                    "max_tokens": self.params.max_new_tokens,
                     "stop": None
                 }
-            ).json()
+            ) as resp:
+                return await resp.json(content_type=None, loads=orjson.loads)
+
+        try:
+            response = await _HEDGER.run(call)
             return response['choices'][0]['message'].get('content')
         except Exception as e:
             if not response:
@@ -273,22 +576,27 @@ class rag():
                         Try setting use_rag to False to see if it is an issue with the context. \n \
                         Response object: {response}. Prompt: {prompt}')
 
-    def _containerized_model(self, prompt: list[dict]) -> str:
+    async def _containerized_model(self, session: aiohttp.ClientSession, prompt: list[dict]) -> str:
         """Child function (3/3) of _augment() that routes to the containerized models"""
         response = None
-        try:
-            response = requests.post(
-                url="https://localai-selfhost.salmonground-3deb4a95.canadaeast.azurecontainerapps.io/chat/completions",
+
+        async def call():
+            async with session.post(
+                url=_CONTAINER_URL,
                 json={
-                    "prompt": self.body,  # RAG disabled; need to refactor the data model
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "frequency_penalty": self.frequency_penalty,
-                    "presence_penalty": self.presence_penalty,
-                    "max_tokens": self.max_new_tokens,
+                    "prompt": self.params.body,  # RAG disabled; need to refactor the data model
+                    "temperature": self.params.temperature,
+                    "top_p": self.params.top_p,
+                    "frequency_penalty": self.params.frequency_penalty,
+                    "presence_penalty": self.params.presence_penalty,
+                    "max_tokens": self.params.max_new_tokens,
                     "stop": None
                 }
-            ).json()
+            ) as resp:
+                return await resp.json(content_type=None, loads=orjson.loads)
+
+        try:
+            response = await _HEDGER.run(call)
             return response['response']
         except Exception as e:
             if not response:
@@ -297,3 +605,13 @@ class rag():
                 raise Exception(f'{e}: Augment error: Container model failed to generate prompt with the given context. \n \
                         Try setting use_rag to False to see if it is an issue with the context. \n \
                         Response object: {response}')
+
+    # Model name -> child function of _augment()
+    _AUGMENT_DISPATCH = {
+        'llama': _ml_studio_model,
+        'mistral': _ml_studio_model,
+        'gpt35_4k': _ai_studio_model,
+        'gpt35_16k': _ai_studio_model,
+        'gpt4_1106': _ai_studio_model,
+        'qwen': _containerized_model
+    }
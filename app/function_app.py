@@ -1,7 +1,12 @@
+import os
+import logging
+# Keep OpenMP from over-subscribing cores when several worker processes share a host (must be set before faiss loads)
+os.environ.setdefault('OMP_NUM_THREADS', '1')
 import azure.functions as func
 import faiss
+import numpy as np
 import pandas as pd
-from backend import rag
+from backend import rag, BatchedIndex
 from utils import read_blob
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ADMIN)
@@ -9,40 +14,52 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ADMIN)
 # Caching global variables
 if 'data' not in globals():
     data = read_blob('data.csv', pd.read_csv)
+    # Column-wise arrays so requests can index chunks by FAISS id without going through pandas.
+    # Empty CSV cells are read as NaN, which would break slicing and string handling downstream
+    data = {column: data[column].fillna('').to_numpy() for column in ['title', 'url', 'chunks']}
 if 'index' not in globals():
-    index = read_blob('chunks.faiss', faiss.read_index)
+    index = read_blob('chunks.faiss', lambda f: faiss.deserialize_index(np.frombuffer(f.getbuffer(), dtype='uint8')))
+    # Search breadth for HNSW indexes (see utils.build_index); raise for better recall at some latency cost
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = int(os.environ.get('FAISS_EF_SEARCH') or 16)
+    # GPU search only beats CPU on batches, so GPU queries are coalesced before searching. Lone queries stay on CPU
+    if os.environ.get('USE_GPU_FAISS') == '1' and faiss.get_num_gpus() > 0:
+        if isinstance(index, faiss.IndexHNSW):
+            logging.warning("USE_GPU_FAISS is set, but HNSW indexes cannot be cloned to GPU. Searching on CPU instead")
+        else:
+            index = BatchedIndex(faiss.index_cpu_to_all_gpus(index), cpu_index=index)
 
 
 @app.route(route="llama")
-def route_llama(req: func.HttpRequest) -> func.HttpResponse:
-    return rag(req, 'llama').generate(data, index)
+async def route_llama(req: func.HttpRequest) -> func.HttpResponse:
+    return await rag(req, 'llama').generate(data, index)
 
 
 @app.route(route="mistral")
-def route_mistral(req: func.HttpRequest) -> func.HttpResponse:
-    return rag(req, 'mistral').generate(data, index)
+async def route_mistral(req: func.HttpRequest) -> func.HttpResponse:
+    return await rag(req, 'mistral').generate(data, index)
 
 
 @app.route(route="qwen")
-def route_qwen(req: func.HttpRequest) -> func.HttpResponse:
-    return rag(req, 'qwen').generate(data, index)
+async def route_qwen(req: func.HttpRequest) -> func.HttpResponse:
+    return await rag(req, 'qwen').generate(data, index)
 
 
 @app.route(route="gpt35a")
 # @app.blob_input(arg_name="datablob", path="app-data/data.csv", connection="BlobStorageConnectionString")
 # @app.blob_input(arg_name="indexblob", path="app-data/chunks.faiss", connection="BlobStorageConnectionString")
-def route_gpt35_4k(req: func.HttpRequest) -> func.HttpResponse:
+async def route_gpt35_4k(req: func.HttpRequest) -> func.HttpResponse:
     # data = pd.read_csv(BytesIO(datablob.read()))
-    return rag(req, 'gpt35_4k').generate(data, index)
+    return await rag(req, 'gpt35_4k').generate(data, index)
 
 
 @app.route(route="gpt35b")
-def route_gpt35_16k(req: func.HttpRequest) -> func.HttpResponse:
-    return rag(req, 'gpt35_16k').generate(data, index)
+async def route_gpt35_16k(req: func.HttpRequest) -> func.HttpResponse:
+    return await rag(req, 'gpt35_16k').generate(data, index)
 
 
 @app.route(route="gpt4")
-def route_gpt4_1106(req: func.HttpRequest) -> func.HttpResponse:
-    return rag(req, 'gpt4_1106').generate(data, index)
+async def route_gpt4_1106(req: func.HttpRequest) -> func.HttpResponse:
+    return await rag(req, 'gpt4_1106').generate(data, index)
 
 
@@ -1,16 +1,21 @@
 import os
+import asyncio
+import inspect
 from time import time
-import tempfile
+from io import BytesIO
+import faiss
+import numpy as np
+from collections import deque
 import tiktoken
 from azure.storage.blob import BlobClient
 
 
 def read_blob(blob_name: str, operation):
-    """Loads from Azure blob storage to a local variable
+    """Loads from Azure blob storage to a local variable. The blob is streamed into memory (no temp file)
     
     Args:
         blob_name : Name of the file on blob storage
-        operation: The function to perform on the blob (ex pd.read_csv, faiss.read_index)
+        operation: The function to perform on the in-memory file object (ex pd.read_csv)
 
     """
     blob = BlobClient(
@@ -20,14 +25,42 @@ def read_blob(blob_name: str, operation):
                 credential=os.environ['STORAGE_KEY']
             )
     
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_file.write(blob.download_blob().readall())
-        temp_file.flush()
-        return operation(temp_file.name)
+    buffer = BytesIO()
+    blob.download_blob(max_concurrency=8).readinto(buffer)
+    buffer.seek(0)
+    return operation(buffer)
+
+
+def build_index(embeddings: np.ndarray, description: str = 'HNSW32') -> faiss.Index:
+    """Builds the FAISS index for the chunk embeddings (run offline, then upload to blob storage as chunks.faiss).
+    The chunks.faiss in blob storage is expected to be an exact flat inner-product index (IndexFlatIP); the app
+    handles either. Note that the GPU path (USE_GPU_FAISS) needs a flat or IVF index, as HNSW cannot run on GPU
+
+    Args:
+        embeddings  : float32 array of shape (n_chunks, 1536) with one row per chunk, in data.csv order
+        description : FAISS index factory string. HNSW32 gives sub-millisecond approximate search;
+                      for corpora over ~1M chunks, use 'IVF4096,PQ64' instead
+
+    """
+    index = faiss.index_factory(embeddings.shape[1], description, faiss.METRIC_INNER_PRODUCT)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efConstruction = 40
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
 
 
 def timer(some_function) -> float:
-    """Decorator for timing function runtime in seconds"""
+    """Decorator for timing function runtime in seconds. Supports both regular and async functions"""
+
+    if inspect.iscoroutinefunction(some_function):
+        async def async_wrapper(*args, **kwargs):
+            t1 = time()
+            result = await some_function(*args, **kwargs)
+            t2 = time()
+            return result, t2 - t1
+        return async_wrapper
 
     def wrapper(*args, **kwargs):
         t1 = time()
@@ -46,4 +79,140 @@ def count_tokens(text: str, model_name: str) -> int:
     """
     encoding = tiktoken.encoding_for_model(model_name)
     ntokens = len(encoding.encode(text))
-    return ntokens
\ No newline at end of file
+    return ntokens
+
+
+class BatchItemError(Exception):
+    """Raised by a Coalescer handler when the batch was rejected because of one of its items (ex. a prompt over the
+    input limit), so retrying the items separately would let the others through"""
+
+
+class Coalescer:
+    """Merges concurrent calls into batches. Items submitted within `max_delay` seconds of each other
+    (up to `batch_size` at a time) are passed together to `handler`, and each caller gets its own result back.
+    If the handler raises BatchItemError, the batch's items are retried one at a time so a single bad item only
+    fails its own caller. Any other error (ex. throttling or a dead endpoint) fails the whole batch at once
+    
+    Args:
+        handler     : async function taking a list of items and returning a list of results in the same order
+        batch_size  : max number of items per handler call
+        max_delay   : how long (in seconds) to wait for more items before dispatching a partial batch
+
+    """
+
+    def __init__(self, handler, batch_size: int = 16, max_delay: float = 0.015) -> None:
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._loop = None
+        self._queue = None
+        self._tasks = set()
+
+    async def submit(self, item):
+        """Queues an item for the next batch and waits for its result"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._spawn(self._collect())
+
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    def _spawn(self, coro) -> None:
+        # Holding a reference keeps background tasks from being garbage collected mid-flight
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _collect(self) -> None:
+        """Background task that drains the queue into batches"""
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._spawn(self._dispatch(batch))
+
+    async def _dispatch(self, batch: list) -> None:
+        items, futures = zip(*batch)
+        try:
+            results = await self.handler(list(items))
+        except BatchItemError as e:
+            if len(batch) > 1:
+                await asyncio.gather(*(self._dispatch([entry]) for entry in batch))
+                return
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class Hedger:
+    """Cuts tail latency by racing a duplicate of any call that is still running after `delay` seconds.
+    The first successful result wins and the other call is cancelled
+    
+    Args:
+        delay   : seconds to wait before sending the duplicate call (roughly the p95 latency)
+        budget  : max fraction of recent calls that may be duplicated, to cap the extra cost
+        window  : how far back (in seconds) calls are counted towards the budget
+
+    """
+
+    def __init__(self, delay: float = 0.8, budget: float = 0.05, window: float = 60) -> None:
+        self.delay = delay
+        self.budget = budget
+        self.window = window
+        self._calls = deque()
+        self._hedges = deque()
+
+    async def run(self, make_call):
+        """Runs `make_call()` (a function returning a new coroutine), hedging it if it is slow"""
+        now = time()
+        # Pruned on every call rather than only when hedging, so fast traffic doesn't grow the deques without bound
+        self._prune(now)
+        self._calls.append(now)
+        tasks = {asyncio.ensure_future(make_call())}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay)
+            if not done and self._allow_hedge():
+                tasks.add(asyncio.ensure_future(make_call()))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _prune(self, now: float) -> None:
+        for timestamps in (self._calls, self._hedges):
+            while timestamps and timestamps[0] < now - self.window:
+                timestamps.popleft()
+
+    def _allow_hedge(self) -> bool:
+        now = time()
+        self._prune(now)
+        if len(self._hedges) + 1 > self.budget * len(self._calls):
+            return False
+        self._hedges.append(now)
+        return True
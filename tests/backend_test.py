@@ -0,0 +1,203 @@
+# Offline tests for app/backend.py. Network calls are replaced with fakes, so no Azure access is needed
+# Run w/    python3.11 -m pytest tests/backend_test.py
+import os
+import sys
+sys.path.append(os.path.join(os.getcwd(), 'app'))
+import base64
+import asyncio
+import unittest
+from unittest import mock
+import faiss
+import numpy as np
+import azure.functions as func
+import backend
+from utils import BatchItemError
+from backend import rag, RagParams, BatchedIndex
+
+
+def make_request(params: dict = None, body: bytes = None) -> func.HttpRequest:
+  return func.HttpRequest(method='GET', url='/api/gpt35a', params=params or {}, body=body)
+
+
+class TestEmbedBatch(unittest.TestCase):
+
+  def setUp(self):
+    environ = mock.patch.dict(os.environ, {'OPENAI_KEY': 'test-key'})
+    environ.start()
+    self.addCleanup(environ.stop)
+    backend._openai_headers.cache_clear()
+    self.addCleanup(backend._openai_headers.cache_clear)
+
+  def fake_session(self, payload: dict, status: int = 200):
+    class Response():
+      async def __aenter__(self):
+        self.status = status
+        return self
+
+      async def __aexit__(self, *args):
+        return False
+
+      async def json(self, **kwargs):
+        return payload
+
+    class Session():
+      def post(self, **kwargs):
+        return Response()
+
+    return Session()
+
+  def test_missing_key_fails_clearly(self):
+    del os.environ['OPENAI_KEY']
+    with self.assertRaisesRegex(KeyError, 'OPENAI_KEY'):
+      asyncio.run(backend._embed_batch(['hi']))
+
+  def test_error_does_not_leak_prompts(self):
+    original = backend._get_session
+    backend._get_session = lambda: self.fake_session({'error': {'message': 'input too long'}})
+    try:
+      with self.assertRaises(Exception) as context:
+        asyncio.run(backend._embed_batch(['secret prompt', 'other prompt']))
+    finally:
+      backend._get_session = original
+
+    self.assertNotIn('secret prompt', str(context.exception))
+    self.assertNotIn('other prompt', str(context.exception))
+
+  def embed_with_status(self, status: int):
+    original = backend._get_session
+    backend._get_session = lambda: self.fake_session({'error': {'message': 'error'}}, status)
+    try:
+      asyncio.run(backend._embed_batch(['a', 'b']))
+    finally:
+      backend._get_session = original
+
+  def test_rejected_input_splits_the_batch(self):
+    with self.assertRaises(BatchItemError):
+      self.embed_with_status(400)
+
+  def test_throttling_fails_the_batch(self):
+    for status in [429, 500, 503]:
+      with self.assertRaises(Exception) as context:
+        self.embed_with_status(status)
+      self.assertNotIsInstance(context.exception, BatchItemError)
+      self.assertIn(str(status), str(context.exception))
+
+  def test_decodes_base64_rows_into_separate_arrays(self):
+    rows = np.arange(2 * backend.EMBED_DIM, dtype='float32').reshape(2, backend.EMBED_DIM)
+    payload = {'data': [
+      {'index': 1, 'embedding': base64.b64encode(rows[1].tobytes()).decode()},
+      {'index': 0, 'embedding': rows[0].tolist()}
+    ]}
+    original = backend._get_session
+    backend._get_session = lambda: self.fake_session(payload)
+    try:
+      embeddings = asyncio.run(backend._embed_batch(['a', 'b']))
+    finally:
+      backend._get_session = original
+
+    np.testing.assert_array_equal(embeddings[0], rows[0:1])
+    np.testing.assert_array_equal(embeddings[1], rows[1:2])
+    self.assertFalse(np.shares_memory(embeddings[0], embeddings[1]))
+
+
+class TestRagParams(unittest.TestCase):
+
+  def test_defaults(self):
+    self.assertEqual(RagParams.from_request(make_request()), RagParams())
+
+  def test_casts_query_parameters(self):
+    params = RagParams.from_request(make_request({
+      'body': 'What is life?', 'use_rag': 'False', 'temperature': '0.2', 'k': '5', 'include_chunks': 'True'
+    }))
+    self.assertEqual(params.body, 'What is life?')
+    self.assertFalse(params.use_rag)
+    self.assertEqual(params.temperature, 0.2)
+    self.assertEqual(params.k, 5)
+    self.assertTrue(params.include_chunks)
+    self.assertTrue(params.do_sample)
+
+  def test_empty_values_use_defaults(self):
+    params = RagParams.from_request(make_request({'body': 'hi', 'max_new_tokens': '', 'use_rag': ''}))
+    self.assertEqual(params.max_new_tokens, 200)
+    self.assertTrue(params.use_rag)
+
+  def test_unknown_parameters_are_ignored(self):
+    self.assertEqual(RagParams.from_request(make_request({'body': 'hi', 'model': 'gpt4'})), RagParams(body='hi'))
+
+  def test_json_body_fallback(self):
+    params = RagParams.from_request(make_request({'k': '2'}, b'{"body": "hi", "k": 7, "include_prompt": true}'))
+    self.assertEqual(params.body, 'hi')
+    self.assertEqual(params.k, 2)  # query string takes precedence over the JSON body
+    self.assertTrue(params.include_prompt)
+
+  def test_invalid_json_body_is_ignored(self):
+    self.assertEqual(RagParams.from_request(make_request(body=b'not json')), RagParams())
+
+
+class TestBatchedIndex(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    self.vectors = rng.random((20, 8), dtype='float32')
+    self.index = faiss.IndexFlatIP(8)
+    self.index.add(self.vectors)
+
+  def counting_index(self, batch_sizes: list):
+    search = self.index.search
+
+    class CountingIndex():
+      def search(self, embeddings, k):
+        batch_sizes.append(len(embeddings))
+        return search(embeddings, k)
+
+    return CountingIndex()
+
+  def test_slices_each_callers_k(self):
+    gpu_batches, cpu_batches = [], []
+
+    async def main():
+      batched = BatchedIndex(self.counting_index(gpu_batches), self.counting_index(cpu_batches), max_delay=0.05)
+      return await asyncio.gather(*[batched.search(self.vectors[i:i+1], k) for i, k in enumerate([2, 1, 3])])
+
+    _, (scores_a, ids_a), (scores_b, ids_b) = asyncio.run(main())
+    # The first query has nothing to batch with, so it skips the queue; the rest are searched together
+    self.assertEqual(cpu_batches, [1])
+    self.assertEqual(gpu_batches, [2])
+    self.assertEqual(ids_a.shape, (1, 1))
+    self.assertEqual(ids_b.shape, (1, 3))
+    np.testing.assert_array_equal(ids_a, self.index.search(self.vectors[1:2], 1)[1])
+    np.testing.assert_array_equal(ids_b, self.index.search(self.vectors[2:3], 3)[1])
+    np.testing.assert_allclose(scores_b, self.index.search(self.vectors[2:3], 3)[0])
+
+  def test_lone_queries_stay_on_cpu(self):
+    gpu_batches, cpu_batches = [], []
+
+    async def main():
+      batched = BatchedIndex(self.counting_index(gpu_batches), self.counting_index(cpu_batches), max_delay=0.05)
+      results = [await batched.search(self.vectors[0:1], 3)]
+      # The third query is queued behind the second, but nothing joins it, so its batch of one goes to CPU too
+      second = asyncio.ensure_future(batched.search(self.vectors[1:2], 3))
+      await asyncio.sleep(0)
+      results.append(await batched.search(self.vectors[2:3], 3))
+      return results + [await second]
+
+    results = asyncio.run(main())
+    self.assertEqual(gpu_batches, [])
+    self.assertEqual(cpu_batches, [1, 1, 1])
+    np.testing.assert_array_equal(results[0][1], self.index.search(self.vectors[0:1], 3)[1])
+
+
+class TestResponseCacheKey(unittest.TestCase):
+
+  def test_key_depends_on_model_and_params(self):
+    request = make_request({'body': 'hi', 'temperature': '0.1'})
+    self.assertEqual(rag(request, 'gpt35_4k')._cache_key(), rag(request, 'gpt35_4k')._cache_key())
+    self.assertNotEqual(rag(request, 'gpt35_4k')._cache_key(), rag(request, 'gpt4_1106')._cache_key())
+    self.assertNotEqual(
+      rag(request, 'gpt35_4k')._cache_key(),
+      rag(make_request({'body': 'hi', 'temperature': '0.1', 'k': '5'}), 'gpt35_4k')._cache_key()
+    )
+
+  def test_skips_high_temperature_and_no_cache(self):
+    self.assertIsNone(rag(make_request({'body': 'hi'}), 'gpt35_4k')._cache_key())
+    self.assertIsNone(rag(make_request({'body': 'hi', 'temperature': '0.1', 'no_cache': 'True'}), 'gpt35_4k')._cache_key())
@@ -4,6 +4,7 @@ import os
 import sys
 sys.path.append(os.path.join(os.getcwd()))
 sys.path.append(os.path.join(os.getcwd(), 'app'))
+import asyncio
 import logging
 import unittest
 import azure.functions as func
@@ -44,7 +45,7 @@ class TestFunction(unittest.TestCase):
 
     # Call the function.
     func_call = route_gpt35_4k.build().get_user_function()
-    resp = func_call(req)
+    resp = asyncio.run(func_call(req))
 
     logging.info(resp.get_body().decode('utf-8'))
 
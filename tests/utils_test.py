@@ -0,0 +1,196 @@
+# Offline tests for the helpers in app/utils.py. No Azure access needed
+# Run w/    python3.11 -m pytest tests/utils_test.py
+import os
+import sys
+sys.path.append(os.path.join(os.getcwd(), 'app'))
+import asyncio
+import unittest
+from time import time
+import faiss
+import numpy as np
+from utils import build_index, BatchItemError, Coalescer, Hedger
+
+class TestBuildIndex(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    self.embeddings = rng.standard_normal((200, 16), dtype='float32')
+    faiss.normalize_L2(self.embeddings)
+
+  def test_default_is_hnsw(self):
+    index = build_index(self.embeddings)
+    self.assertIsInstance(index, faiss.IndexHNSW)
+    self.assertEqual(index.hnsw.efConstruction, 40)
+    self.assertEqual(index.metric_type, faiss.METRIC_INNER_PRODUCT)
+    self.assertEqual(index.ntotal, len(self.embeddings))
+
+  def test_each_chunk_finds_itself(self):
+    for description in ['HNSW32', 'Flat']:
+      index = build_index(self.embeddings, description)
+      _, ids = index.search(self.embeddings, 1)
+      np.testing.assert_array_equal(ids[:, 0], np.arange(len(self.embeddings)), err_msg=description)
+
+  def test_survives_serialization(self):
+    # function_app.py loads chunks.faiss with faiss.deserialize_index
+    index = faiss.deserialize_index(faiss.serialize_index(build_index(self.embeddings)))
+    _, ids = index.search(self.embeddings[:5], 1)
+    np.testing.assert_array_equal(ids[:, 0], np.arange(5))
+
+
+class TestCoalescer(unittest.TestCase):
+
+  def test_splits_into_batches(self):
+    batches = []
+
+    async def handler(items):
+      batches.append(items)
+      return [item * 2 for item in items]
+
+    async def main():
+      coalescer = Coalescer(handler, batch_size=3, max_delay=0.05)
+      return await asyncio.gather(*[coalescer.submit(i) for i in range(7)])
+
+    self.assertEqual(asyncio.run(main()), [0, 2, 4, 6, 8, 10, 12])
+    self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6]])
+
+  def test_late_items_go_in_the_next_batch(self):
+    batches = []
+
+    async def handler(items):
+      batches.append(items)
+      return items
+
+    async def main():
+      coalescer = Coalescer(handler, batch_size=16, max_delay=0.01)
+      first = asyncio.ensure_future(coalescer.submit('a'))
+      await asyncio.sleep(0.05)
+      return await asyncio.gather(first, coalescer.submit('b'))
+
+    self.assertEqual(asyncio.run(main()), ['a', 'b'])
+    self.assertEqual(batches, [['a'], ['b']])
+
+  def test_failing_item_only_fails_its_own_caller(self):
+    batches = []
+
+    async def handler(items):
+      batches.append(items)
+      if 'bad' in items:
+        raise BatchItemError('bad input')
+      return [item.upper() for item in items]
+
+    async def main():
+      coalescer = Coalescer(handler, batch_size=4, max_delay=0.05)
+      return await asyncio.gather(*[coalescer.submit(item) for item in ['a', 'bad', 'c']], return_exceptions=True)
+
+    a, bad, c = asyncio.run(main())
+    self.assertEqual((a, c), ('A', 'C'))
+    self.assertIsInstance(bad, BatchItemError)
+    self.assertEqual(batches[0], ['a', 'bad', 'c'])
+    self.assertEqual(sorted(map(tuple, batches[1:])), [('a',), ('bad',), ('c',)])
+
+  def test_shared_failure_reaches_every_caller(self):
+    batches = []
+
+    async def handler(items):
+      batches.append(items)
+      raise ConnectionError('endpoint down')
+
+    async def main():
+      coalescer = Coalescer(handler, batch_size=4, max_delay=0.05)
+      return await asyncio.gather(*[coalescer.submit(i) for i in range(3)], return_exceptions=True)
+
+    for result in asyncio.run(main()):
+      self.assertIsInstance(result, ConnectionError)
+    # Throttling or a dead endpoint would fail every retry too, so the batch is not split
+    self.assertEqual(batches, [[0, 1, 2]])
+
+
+class TestHedger(unittest.TestCase):
+
+  def test_slow_call_is_hedged_and_loser_cancelled(self):
+    calls = []
+    cancelled = []
+
+    async def call():
+      attempt = len(calls)
+      calls.append(attempt)
+      try:
+        await asyncio.sleep(1 if attempt == 0 else 0.01)
+      except asyncio.CancelledError:
+        cancelled.append(attempt)
+        raise
+      return attempt
+
+    async def main():
+      hedger = Hedger(delay=0.05, budget=0.5)
+      hedger._calls.extend([time()] * 10)  # recent traffic, so the budget allows a hedge
+      result = await hedger.run(call)
+      await asyncio.sleep(0)
+      return result
+
+    self.assertEqual(asyncio.run(main()), 1)
+    self.assertEqual(calls, [0, 1])
+    self.assertEqual(cancelled, [0])
+
+  def test_budget_limits_hedges(self):
+    calls = []
+
+    async def call():
+      calls.append(None)
+      await asyncio.sleep(0.1)
+      return 'done'
+
+    async def main():
+      hedger = Hedger(delay=0.01, budget=0.05)
+      return await hedger.run(call)
+
+    # A single call is below the 5% budget, so no duplicate is sent
+    self.assertEqual(asyncio.run(main()), 'done')
+    self.assertEqual(len(calls), 1)
+
+  def test_cancelling_the_request_cancels_the_call(self):
+    cancelled = []
+
+    async def call():
+      try:
+        await asyncio.sleep(1)
+      except asyncio.CancelledError:
+        cancelled.append(True)
+        raise
+
+    async def main():
+      hedger = Hedger(delay=0.5, budget=0.05)
+      request = asyncio.ensure_future(hedger.run(call))
+      await asyncio.sleep(0.01)
+      request.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await request
+      await asyncio.sleep(0)
+      # Checked inside the loop, since asyncio.run cancels any leftover tasks on exit
+      self.assertEqual(cancelled, [True])
+
+    asyncio.run(main())
+
+  def test_old_calls_are_forgotten(self):
+    async def call():
+      return 'done'
+
+    async def main():
+      hedger = Hedger(delay=1, window=60)
+      hedger._calls.extend([time() - 120] * 1000)  # traffic from before the window
+      for _ in range(3):
+        await hedger.run(call)
+      return hedger
+
+    # Fast calls never reach the hedging check, but still clear out expired timestamps
+    self.assertEqual(len(asyncio.run(main())._calls), 3)
+
+  def test_raises_when_every_call_fails(self):
+    async def call():
+      raise ValueError('model down')
+
+    async def main():
+      return await Hedger(delay=0.01).run(call)
+
+    with self.assertRaises(ValueError):
+      asyncio.run(main())